@@ -2,7 +2,9 @@ import pandas as pd
 import streamlit as st
 
 from rfm import (
-    build_rfm_table,
+    MINIBATCH_MIN_CLIENTES,
+    build_rfm_table_streaming,
+    build_rfm_features,
     calcular_wcss,
     get_numero_otimo_clusters,
     cluster_rfm_joint,
@@ -11,12 +13,146 @@ from charts import render_scatter_grid
 from llm_gemini import (
     list_gemini_models,
     build_cluster_naming_prompt,
-    gemini_generate_json,
+    gemini_generate_json_stream,
+    parse_llm_json,
     build_cluster_labels,
 )
 
 st.set_page_config(page_title="RFM Segmentation", layout="wide")
 
+
+# Cache: evita refazer leitura do CSV, RFM e KMeans a cada rerun do Streamlit
+def _hash_dataframe(df: pd.DataFrame) -> bytes:
+    return pd.util.hash_pandas_object(df, index=True).values.tobytes()
+
+
+_HASH_FUNCS = {pd.DataFrame: _hash_dataframe}
+
+
+PREVIEW_ROWS = 20
+CSV_CHUNKSIZE = 1_000_000
+# Cada entrada guarda uma cópia (RFM, features, CSV...): limita o que fica no servidor
+CACHE_MAX_ENTRIES = 4
+
+
+def _file_key(up) -> str:
+    # Identifica o upload sem hashear o conteúdo (O(1) por rerun)
+    return f"{up.file_id}:{up.size}"
+
+
+def _rewind(up):
+    up.seek(0)
+    return up
+
+
+# Parâmetros com "_" não entram na chave do cache: o arquivo é identificado por file_key
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def load_csv_preview(file_key: str, _up, nrows: int = PREVIEW_ROWS) -> pd.DataFrame:
+    return pd.read_csv(_rewind(_up), nrows=nrows)
+
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def column_unique_values(file_key: str, _up, col: str, limit: int = 1000) -> list[str]:
+    # Lida como texto (mesmo critério do build_rfm_table_streaming): evita que o
+    # dtype inferido por chunk gere opções repetidas como 1 e "1"
+    uniq = None
+    reader = pd.read_csv(_rewind(_up), usecols=[col], dtype={col: str}, chunksize=CSV_CHUNKSIZE)
+    for chunk in reader:
+        u = chunk[col].dropna().drop_duplicates()
+        uniq = u if uniq is None else pd.concat([uniq, u]).drop_duplicates()
+        if len(uniq) > limit:  # coluna de alta cardinalidade: não serve como status
+            break
+
+    if uniq is None:
+        return []
+    return uniq.sort_values().head(limit).tolist()
+
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def build_rfm_table_cached(
+    file_key: str,
+    _up,
+    customer_col: str,
+    date_col: str,
+    monetary_col: str,
+    order_col: str | None,
+    approved_col: str | None,
+    approved_values: list[str],
+    date_format: str | None,
+) -> pd.DataFrame:
+    return build_rfm_table_streaming(
+        _rewind(_up),
+        customer_col=customer_col,
+        date_col=date_col,
+        monetary_col=monetary_col,
+        order_col=order_col,
+        approved_col=approved_col,
+        approved_values=approved_values,
+        date_format=date_format,
+        chunksize=CSV_CHUNKSIZE,
+    )
+
+
+@st.cache_data(show_spinner=False, hash_funcs=_HASH_FUNCS, max_entries=CACHE_MAX_ENTRIES)
+def build_rfm_features_cached(rfm: pd.DataFrame):
+    return build_rfm_features(rfm)
+
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def calcular_wcss_cached(Xs, k_min: int, k_max: int, random_state: int) -> list[float]:
+    # MiniBatch só em bases muito grandes: o k automático passa a depender da seed
+    return calcular_wcss(
+        Xs,
+        k_min=k_min,
+        k_max=k_max,
+        random_state=random_state,
+        use_minibatch=len(Xs) >= MINIBATCH_MIN_CLIENTES,
+    )
+
+
+@st.cache_data(show_spinner=False, hash_funcs=_HASH_FUNCS, max_entries=CACHE_MAX_ENTRIES)
+def cluster_rfm_joint_cached(
+    rfm: pd.DataFrame,
+    n_clusters: int,
+    random_state: int,
+    precomputed: tuple | None = None,
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    # precomputed vem de build_rfm_features_cached (cópia nova a cada chamada): Xs é nosso
+    return cluster_rfm_joint(
+        rfm=rfm,
+        n_clusters=n_clusters,
+        random_state=random_state,
+        precomputed=precomputed,
+        copy_x=False,
+    )
+
+
+@st.cache_data(show_spinner=False, hash_funcs=_HASH_FUNCS, max_entries=CACHE_MAX_ENTRIES)
+def df_to_csv_bytes(df: pd.DataFrame) -> bytes:
+    return df.to_csv(index=False).encode("utf-8")
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def list_gemini_models_cached(api_key: str) -> list[str]:
+    return list_gemini_models(api_key)
+
+
+def render_segments(prof_named: pd.DataFrame) -> None:
+    st.subheader("Explicações por segmento")
+    for row in prof_named.sort_values("RankQualidade").itertuples(index=False):
+        nome = getattr(row, "SegmentoNome", f"Cluster {int(row.ClusterId)}")
+        desc = getattr(row, "SegmentoDescricao", "")
+        estrategias = getattr(row, "Estrategias", [])
+        st.markdown(f"### {nome}")
+        if desc:
+            st.write(desc)
+        if isinstance(estrategias, list) and estrategias:
+            st.write("**Ações sugeridas:**")
+            for a in estrategias:
+                st.write(f"- {a}")
+        st.write("---")
+
+
 # Estado
 for key, default in {
     "rfm_out": None,
@@ -79,7 +215,7 @@ with st.sidebar:
 
     if st.button("Carregar modelos", disabled=not api_key):
         try:
-            st.session_state["gemini_models"] = list_gemini_models(api_key)
+            st.session_state["gemini_models"] = list_gemini_models_cached(api_key)
             st.success("Modelos carregados")
         except Exception as e:
             st.session_state["gemini_models"] = []
@@ -101,16 +237,23 @@ if not up:
     st.info("Faça upload de um CSV para começar.")
     st.stop()
 
-df = pd.read_csv(up)
+# Só a prévia é carregada em memória; o RFM lê o arquivo em chunks
+file_key = _file_key(up)
+preview = load_csv_preview(file_key, up)
 st.subheader("Prévia do dataset")
-st.dataframe(df.head(20), use_container_width=True)
+st.dataframe(preview, use_container_width=True)
 
-cols = df.columns.tolist()
+cols = preview.columns.tolist()
 
 with st.form("rfm_form"):
     st.subheader("Mapeamento de colunas")
     customer_col = st.selectbox("Cliente", cols)
     date_col = st.selectbox("Data", cols)
+    date_format = st.text_input(
+        "Formato da data (opcional)",
+        placeholder="Ex: %Y-%m-%d %H:%M:%S",
+        help="Informar o formato acelera a leitura das datas; vazio = detecção automática.",
+    ).strip() or None
     monetary_col = st.selectbox("Valor", cols)
 
     order_col = st.selectbox("Pedido (opcional)", ["(não tenho)"] + cols)
@@ -121,7 +264,7 @@ with st.form("rfm_form"):
 
     approved_values = []
     if approved_col:
-        uniq = pd.Series(df[approved_col].astype(str).unique()).sort_values().tolist()
+        uniq = column_unique_values(file_key, up, approved_col)
         approved_values = st.multiselect("Valores aprovados", uniq)
 
     submit = st.form_submit_button("🚀 Rodar RFM + Clusterização")
@@ -129,33 +272,32 @@ with st.form("rfm_form"):
 
 if submit:
     try:
-        rfm_table = build_rfm_table(
-            data=df,
+        rfm_table = build_rfm_table_cached(
+            file_key=file_key,
+            _up=up,
             customer_col=customer_col,
             date_col=date_col,
             monetary_col=monetary_col,
             order_col=order_col,
             approved_col=approved_col,
             approved_values=approved_values,
+            date_format=date_format,
         )
 
+        # Features padronizadas uma única vez: usadas no WCSS e no cluster_rfm_joint
+        feats = build_rfm_features_cached(rfm_table)
+
         # escolher k (se automático)
         chosen_k = n_clusters
         if chosen_k is None:
-            # Para WCSS precisamos do X padronizado; cluster_rfm_joint já faz internamente,
-            # mas aqui faremos via chamada leve: cluster_rfm_joint exige k. Então:
-            # -> calculamos WCSS em um X construído dentro do próprio rfm.py? Mantive simples:
-            #    fazemos um "cluster_rfm_joint" só no k=2..10? Não: vamos usar helpers do rfm.py.
-            # Como precisamos de Xs, usamos o próprio cluster_rfm_joint depois. Para WCSS, construímos Xs via rfm.py:
-            from rfm import build_rfm_features  # import local para evitar circularidade
-            Xs, _ = build_rfm_features(rfm_table)
-            wcss = calcular_wcss(Xs, k_min=2, k_max=10, random_state=int(random_state))
+            wcss = calcular_wcss_cached(feats[0], k_min=2, k_max=10, random_state=int(random_state))
             chosen_k = get_numero_otimo_clusters(wcss, k_min=2, k_max=10)
 
-        rfm_out, cluster_profile = cluster_rfm_joint(
+        rfm_out, cluster_profile = cluster_rfm_joint_cached(
             rfm=rfm_table,
             n_clusters=int(chosen_k),
             random_state=int(random_state),
+            precomputed=feats,
         )
 
         st.session_state["rfm_out"] = rfm_out
@@ -185,14 +327,14 @@ st.dataframe(rfm_out, use_container_width=True)
 
 st.download_button(
     "⬇️ Baixar CSV (clientes)",
-    rfm_out.to_csv(index=False).encode("utf-8"),
+    df_to_csv_bytes(rfm_out),
     "rfm_clientes.csv",
     "text/csv",
 )
 
 st.download_button(
     "⬇️ Baixar CSV (perfil clusters)",
-    cluster_profile.to_csv(index=False).encode("utf-8"),
+    df_to_csv_bytes(cluster_profile),
     "rfm_clusters_perfil.csv",
     "text/csv",
 )
@@ -212,9 +354,21 @@ else:
             st.code(prompt)
 
         try:
-            with st.spinner("Chamando Gemini..."):
-                llm_json = gemini_generate_json(api_key=api_key, model=model, prompt=prompt)
-                labels_df = build_cluster_labels(cluster_profile, llm_json)
+            # Mostra a resposta visível enquanto é gerada; o JSON é lido ao final do stream
+            stream_area = st.empty()
+            with stream_area.container():
+                st.caption("Gerando resposta do Gemini...")
+                llm_text = st.write_stream(
+                    gemini_generate_json_stream(api_key=api_key, model=model, prompt=prompt)
+                )
+
+            # Concluído: recolhe o texto bruto num expander
+            stream_area.empty()
+            with st.expander("📝 Resposta da LLM", expanded=False):
+                st.code(llm_text)
+
+            llm_json = parse_llm_json(llm_text)
+            labels_df = build_cluster_labels(cluster_profile, llm_json)
 
             st.session_state["cluster_labels"] = labels_df
             st.success("Rótulos gerados com sucesso!")
@@ -228,26 +382,15 @@ labels_df = st.session_state.get("cluster_labels")
 if labels_df is None:
     st.info("Gere os nomes via Gemini para enriquecer os gráficos e as descrições.")
 else:
-    # Merge dos rótulos nos clientes e no perfil
-    rfm_named = rfm_out.merge(labels_df, on="ClusterId", how="left")
+    # Merge dos rótulos nos clientes (só o nome, usado nos gráficos) e no perfil
+    rfm_named = rfm_out.merge(labels_df[["ClusterId", "SegmentoNome"]], on="ClusterId", how="left")
+    rfm_named["SegmentoNome"] = rfm_named["SegmentoNome"].astype("category")
     prof_named = cluster_profile.merge(labels_df, on="ClusterId", how="left")
 
     st.subheader("Clusters nomeados (LLM)")
     st.dataframe(prof_named, use_container_width=True)
 
-    st.subheader("Explicações por segmento")
-    for _, row in prof_named.sort_values("RankQualidade").iterrows():
-        nome = row.get("SegmentoNome", f"Cluster {int(row['ClusterId'])}")
-        desc = row.get("SegmentoDescricao", "")
-        estrategias = row.get("Estrategias", [])
-        st.markdown(f"### {nome}")
-        if desc:
-            st.write(desc)
-        if isinstance(estrategias, list) and estrategias:
-            st.write("**Ações sugeridas:**")
-            for a in estrategias:
-                st.write(f"- {a}")
-        st.write("---")
+    render_segments(prof_named)
 
     st.divider()
     st.header("📈 Gráficos (com rótulos descritivos)")
@@ -1,25 +1,54 @@
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
+import plotly.express as px
+import plotly.graph_objects as go
 import streamlit as st
 
+# Máximo de pontos enviados ao navegador por gráfico; acima disso não ganha informação
+SAMPLE_CAP = 20_000
+
 
 def _segment_col(rfm_df: pd.DataFrame) -> str:
     return "SegmentoNome" if "SegmentoNome" in rfm_df.columns else "ClusterId"
 
 
+def _sample_by_group(rfm_df: pd.DataFrame, group_col: str, cap: int = SAMPLE_CAP) -> pd.DataFrame:
+    """
+    Amostra estratificada para plot: no máximo ~cap pontos no total,
+    com a mesma cota por grupo para que clusters pequenos continuem visíveis.
+    """
+    if len(rfm_df) <= cap:
+        return rfm_df
+
+    # Particiona uma única vez: embaralha as linhas e mantém as primeiras
+    # per_group de cada grupo (posição dentro do grupo via cumcount)
+    codes, uniques = pd.factorize(rfm_df[group_col])
+    per_group = max(1, cap // max(1, len(uniques)))
+    order = np.random.default_rng(0).permutation(len(rfm_df))
+    shuffled = codes[order]
+    pos_in_group = pd.Series(shuffled).groupby(shuffled, sort=False).cumcount().to_numpy()
+    return rfm_df.iloc[np.sort(order[pos_in_group < per_group])]
+
+
+@st.cache_data(show_spinner=False, max_entries=6)  # 3 gráficos x 2 resultados
+def _scatter_figure(plot_df: pd.DataFrame, x: str, y: str, group_col: str) -> go.Figure:
+    plot_df = _sample_by_group(plot_df, group_col)
+    return px.scatter(
+        plot_df,
+        x=x,
+        y=y,
+        color=plot_df[group_col].astype(str),
+        labels={"color": group_col},
+        opacity=0.7,
+        render_mode="webgl",
+    )
+
+
 def scatter_by_group(rfm_df: pd.DataFrame, x: str, y: str) -> None:
     group_col = _segment_col(rfm_df)
-    groups = rfm_df[group_col].astype(str).unique().tolist()
-
-    fig, ax = plt.subplots()
-    for g in groups:
-        part = rfm_df[rfm_df[group_col].astype(str) == str(g)]
-        ax.scatter(part[x], part[y], label=str(g), alpha=0.7)
-    ax.set_xlabel(x)
-    ax.set_ylabel(y)
-    ax.legend()
-    st.pyplot(fig)
-    plt.close(fig)
+    # Só as colunas do gráfico entram na chave do cache
+    fig = _scatter_figure(rfm_df[[x, y, group_col]], x, y, group_col)
+    st.plotly_chart(fig, use_container_width=True)
 
 
 def render_scatter_grid(rfm_df: pd.DataFrame) -> None:
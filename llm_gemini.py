@@ -1,16 +1,41 @@
 import json
+import re
+from collections.abc import Iterator
+from functools import lru_cache
 import pandas as pd
 from google import genai
 from google.genai import errors as genai_errors
 
+try:
+    import orjson  # parser JSON em C, opcional
+except ImportError:
+    orjson = None
+
+# Cercas de código (```json ... ```) que alguns modelos colocam em volta do JSON
+_FENCE_RE = re.compile(r"\A```(?:json)?\s*|\s*```\Z")
+
+
+def _loads_json(text: str) -> dict:
+    # orjson.JSONDecodeError herda de json.JSONDecodeError
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+@lru_cache(maxsize=4)
+def _client(api_key: str) -> genai.Client:
+    # Um client por chave: reaproveita o pool de conexões HTTP (keep-alive/TLS)
+    return genai.Client(api_key=api_key)
+
 
 def list_gemini_models(api_key: str) -> list[str]:
-    client = genai.Client(api_key=api_key)
-    models: list[str] = []
-    for m in client.models.list():
-        if hasattr(m, "supported_actions") and "generateContent" in m.supported_actions:
-            models.append(m.name.replace("models/", ""))
-    return sorted(set(models))
+    client = _client(api_key)
+    models: set[str] = set()
+    # page_size maior = menos round-trips de paginação
+    for m in client.models.list(config={"page_size": 100}):
+        if "generateContent" in (getattr(m, "supported_actions", None) or ()):
+            models.add(m.name.replace("models/", ""))
+    return sorted(models)
 
 
 
@@ -97,25 +122,50 @@ Tabela agregada (CSV):
 """.strip()
 
 
+def parse_llm_json(text: str) -> dict:
+    """
+    Converte a resposta textual da LLM em dict (removendo cercas de código, se houver).
+    """
+    # Alguns modelos podem devolver cercas; tenta limpar de forma conservadora
+    text = _FENCE_RE.sub("", (text or "").strip())
+    try:
+        return _loads_json(text)
+    except json.JSONDecodeError as e:
+        raise RuntimeError(f"Falha ao decodificar JSON da LLM. Resposta recebida:\n{text}") from e
+
+
 def gemini_generate_json(api_key: str, model: str, prompt: str) -> dict:
-    client = genai.Client(api_key=api_key)
+    client = _client(api_key)
     try:
         resp = client.models.generate_content(model=model, contents=prompt)
-        text = getattr(resp, "text", "")
+    except genai_errors.ClientError as e:
+        raise RuntimeError(f"Gemini ClientError: {e}") from e
 
-        # Alguns modelos podem devolver cercas; tenta limpar de forma conservadora
-        text = text.strip()
-        if text.startswith("```"):
-            text = text.strip("`")
-            # remove possível linguagem "json\n"
-            text = text.replace("json\n", "", 1).strip()
+    return parse_llm_json(getattr(resp, "text", ""))
 
-        return json.loads(text)
+
+def gemini_generate_json_stream(api_key: str, model: str, prompt: str) -> Iterator[str]:
+    """
+    Versão em streaming: devolve os trechos de texto conforme chegam (p/ st.write_stream).
+    O JSON é interpretado depois, com parse_llm_json sobre o texto completo.
+    Interrompe cedo se a resposta claramente não começa como JSON.
+    """
+    client = _client(api_key)
+    recebido = ""
+    try:
+        for chunk in client.models.generate_content_stream(model=model, contents=prompt):
+            t = getattr(chunk, "text", "") or ""
+            if not t:
+                continue
+
+            inicio_vazio = not recebido.strip()
+            recebido += t
+            if inicio_vazio and recebido.strip() and recebido.lstrip()[0] not in "{`":
+                raise RuntimeError(f"Resposta da LLM não é JSON. Resposta recebida:\n{recebido}")
+            yield t
 
     except genai_errors.ClientError as e:
         raise RuntimeError(f"Gemini ClientError: {e}") from e
-    except json.JSONDecodeError as e:
-        raise RuntimeError(f"Falha ao decodificar JSON da LLM. Resposta recebida:\n{text}") from e
 
 
 def build_cluster_labels(cluster_profile: pd.DataFrame, llm_json: dict) -> pd.DataFrame:
@@ -1,8 +1,57 @@
-import math
 import numpy as np
 import pandas as pd
-from sklearn.cluster import KMeans
+from joblib import Parallel, delayed
+from pandas.tseries.api import guess_datetime_format
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from sklearn.preprocessing import StandardScaler
+from threadpoolctl import threadpool_limits
+
+
+def _needed_columns(*cols: str | None) -> list[str]:
+    """Colunas mapeadas (sem None e sem repetição), na ordem recebida."""
+    return list(dict.fromkeys(c for c in cols if c))
+
+
+def _approved_mask(col: pd.Series, approved_values: list[str]) -> pd.Series:
+    """
+    Máscara de status aprovado sem converter a coluna inteira para str:
+    os poucos valores aprovados é que são convertidos para o dtype da coluna.
+    """
+    if pd.api.types.is_string_dtype(col):
+        return col.isin(set(map(str, approved_values)))
+
+    if pd.api.types.is_numeric_dtype(col) and not pd.api.types.is_bool_dtype(col):
+        vals = pd.to_numeric(pd.Series(list(approved_values)), errors="coerce").dropna()
+        return col.isin(set(vals))
+
+    # dtypes mistos/bool/datas: compara como texto (mesmo critério do widget)
+    return col.astype(str).isin(set(map(str, approved_values)))
+
+
+def _prepare_transactions(
+    df: pd.DataFrame,
+    customer_col: str,
+    date_col: str,
+    monetary_col: str,
+    approved_col: str | None,
+    approved_values: list[str],
+    date_format: str | None = None,
+) -> pd.DataFrame:
+    """
+    Normaliza tipos (data, valor) e aplica o filtro de status aprovado.
+    Compartilhado entre a versão em memória e a versão em chunks.
+    date_format (ex: "%Y-%m-%d %H:%M:%S") evita a inferência de formato, bem mais lenta.
+    """
+    # Coerções primeiro (atribuição de coluna inteira), depois um único filtro de linhas
+    if not pd.api.types.is_datetime64_any_dtype(df[date_col]):
+        df[date_col] = pd.to_datetime(df[date_col], errors="coerce", format=date_format)
+    df[monetary_col] = pd.to_numeric(df[monetary_col], errors="coerce").fillna(0)
+
+    mask = df[customer_col].notna() & df[date_col].notna()
+    if approved_col and approved_values:
+        mask &= _approved_mask(df[approved_col], approved_values)
+
+    return df.loc[mask]
 
 
 def build_rfm_table(
@@ -13,33 +62,122 @@ def build_rfm_table(
     order_col: str | None,
     approved_col: str | None,
     approved_values: list[str],
+    date_format: str | None = None,
 ) -> pd.DataFrame:
-    df = data.copy()
+    # Só as colunas mapeadas; cópia rasa basta para reatribuir colunas sem tocar em `data`
+    needed = _needed_columns(customer_col, date_col, monetary_col, order_col, approved_col)
+    df = _prepare_transactions(
+        data.loc[:, needed].copy(deep=False),
+        customer_col, date_col, monetary_col, approved_col, approved_values, date_format,
+    )
 
-    df[date_col] = pd.to_datetime(df[date_col], errors="coerce")
-    df = df.dropna(subset=[customer_col, date_col])
+    # Recência, Frequência e Receita numa única passada de groupby
+    grouped = df.groupby(customer_col, sort=False)
+    if order_col:
+        rfm = grouped.agg(
+            _last=(date_col, "max"),
+            Frequencia=(order_col, "nunique"),
+            Receita=(monetary_col, "sum"),
+        )
+    else:
+        rfm = grouped.agg(_last=(date_col, "max"), Receita=(monetary_col, "sum"))
+        rfm["Frequencia"] = grouped.size()
 
-    if approved_col and approved_values:
-        df = df[df[approved_col].astype(str).isin([str(v) for v in approved_values])]
+    rfm["Recencia"] = (rfm["_last"].max() - rfm["_last"]).dt.days
 
-    df[monetary_col] = pd.to_numeric(df[monetary_col], errors="coerce").fillna(0)
+    rfm = rfm.reset_index()[[customer_col, "Recencia", "Frequencia", "Receita"]]
+    rfm = rfm.rename(columns={customer_col: "Cliente"})
+    return rfm
+
+
+def _compact(frames: list[pd.DataFrame], reduce, force: bool = False) -> None:
+    """
+    Junta os parciais de frames num único frame reduzido (in place).
+    Só reduz quando o pendente (frames[1:]) já soma tantas linhas quanto o
+    acumulado (frames[0]): o custo total fica linear no número de chunks,
+    em vez de reprocessar o acumulado a cada chunk.
+    """
+    if len(frames) < 2:
+        return
+    if force or sum(len(f) for f in frames[1:]) >= len(frames[0]):
+        frames[:] = [reduce(pd.concat(frames))]
 
-    # Recência
-    last_buy = df.groupby(customer_col)[date_col].max().reset_index()
-    ref_date = last_buy[date_col].max()
-    last_buy["Recencia"] = (ref_date - last_buy[date_col]).dt.days
-    last_buy = last_buy[[customer_col, "Recencia"]]
 
-    # Frequência
+def build_rfm_table_streaming(
+    path_or_buf,
+    customer_col: str,
+    date_col: str,
+    monetary_col: str,
+    order_col: str | None,
+    approved_col: str | None,
+    approved_values: list[str],
+    date_format: str | None = None,
+    sep: str = ",",
+    chunksize: int = 1_000_000,
+) -> pd.DataFrame:
+    """
+    Mesma saída de build_rfm_table, mas lendo o CSV em chunks.
+    As transações brutas nunca são carregadas inteiras: ficam em memória só os
+    agregados por cliente, O(clientes), e, se houver pedido, os pares
+    cliente/pedido distintos, O(pares distintos).
+    """
+    usecols = _needed_columns(customer_col, date_col, monetary_col, order_col, approved_col)
+    agg_spec = {"_last": "max", "Receita": "sum"}
+    if not order_col:
+        agg_spec["Frequencia"] = "sum"
+
+    def reduce_parts(df: pd.DataFrame) -> pd.DataFrame:
+        return df.groupby(level=0).agg(agg_spec)
+
+    # O parser infere dtypes por chunk: chaves como texto evitam que o mesmo id
+    # vire int num chunk e str em outro (e seja contado como cliente/pedido diferente)
+    key_dtypes = {c: str for c in (customer_col, order_col, approved_col) if c}
+
+    parts: list[pd.DataFrame] = []
+    pedidos: list[pd.DataFrame] = []
+    reader = pd.read_csv(
+        path_or_buf, sep=sep, usecols=usecols, dtype=key_dtypes, chunksize=chunksize
+    )
+    for chunk in reader:
+        # Sem formato informado, infere uma vez (1º valor não nulo, como o to_datetime
+        # faz na coluna inteira) e usa o mesmo formato em todos os chunks
+        if date_format is None and not pd.api.types.is_datetime64_any_dtype(chunk[date_col]):
+            primeiro = chunk[date_col].dropna()
+            if not primeiro.empty:
+                date_format = guess_datetime_format(str(primeiro.iloc[0]))
+
+        chunk = _prepare_transactions(
+            chunk, customer_col, date_col, monetary_col, approved_col, approved_values, date_format
+        )
+        if chunk.empty:
+            continue
+
+        grouped = chunk.groupby(customer_col)
+        part = grouped.agg(_last=(date_col, "max"), Receita=(monetary_col, "sum"))
+
+        # Frequência: pedidos distintos precisam de dedup entre chunks
+        if order_col:
+            pedidos.append(chunk[[customer_col, order_col]].drop_duplicates())
+            _compact(pedidos, pd.DataFrame.drop_duplicates)
+        else:
+            part["Frequencia"] = grouped.size()
+
+        parts.append(part)
+        _compact(parts, reduce_parts)
+
+    if not parts:
+        return pd.DataFrame(columns=["Cliente", "Recencia", "Frequencia", "Receita"])
+
+    _compact(parts, reduce_parts, force=True)
+    acc = parts[0]
+
     if order_col:
-        freq = df.groupby(customer_col)[order_col].nunique().reset_index(name="Frequencia")
-    else:
-        freq = df.groupby(customer_col).size().reset_index(name="Frequencia")
+        _compact(pedidos, pd.DataFrame.drop_duplicates, force=True)
+        acc["Frequencia"] = pedidos[0].groupby(customer_col)[order_col].nunique()
 
-    # Receita
-    rev = df.groupby(customer_col)[monetary_col].sum().reset_index(name="Receita")
+    acc["Recencia"] = (acc["_last"].max() - acc["_last"]).dt.days
 
-    rfm = last_buy.merge(freq, on=customer_col).merge(rev, on=customer_col)
+    rfm = acc.reset_index()[[customer_col, "Recencia", "Frequencia", "Receita"]]
     rfm = rfm.rename(columns={customer_col: "Cliente"})
     return rfm
 
@@ -50,7 +188,7 @@ def build_rfm_features(rfm: pd.DataFrame) -> tuple[np.ndarray, pd.DataFrame]:
     - R_inv = -Recencia (maior = melhor)
     - F_log = log1p(Frequencia)
     - M_log = log1p(Receita)
-    Depois padroniza via StandardScaler.
+    Depois padroniza via StandardScaler (em float32).
     Retorna (Xs, rfm_enriquecido).
     """
     out = rfm.copy()
@@ -58,18 +196,52 @@ def build_rfm_features(rfm: pd.DataFrame) -> tuple[np.ndarray, pd.DataFrame]:
     out["F_log"] = np.log1p(out["Frequencia"])
     out["M_log"] = np.log1p(out["Receita"])
 
-    X = out[["R_inv", "F_log", "M_log"]].values
-    Xs = StandardScaler().fit_transform(X)
+    # float32: metade da banda de memória no KMeans, precisão de sobra para 3 features
+    X = out[["R_inv", "F_log", "M_log"]].to_numpy(dtype=np.float32)
+    Xs = StandardScaler(copy=False).fit_transform(X)
     return Xs, out
 
 
-def calcular_wcss(Xs: np.ndarray, k_min: int = 2, k_max: int = 10, random_state: int = 42) -> list[float]:
-    wcss = []
-    for k in range(k_min, k_max + 1):
+# A partir de quantos clientes vale usar MiniBatchKMeans no cotovelo (ver calcular_wcss)
+MINIBATCH_MIN_CLIENTES = 500_000
+
+
+def _fit_inertia(Xs: np.ndarray, k: int, random_state: int, use_minibatch: bool) -> float:
+    if use_minibatch:
+        km = MiniBatchKMeans(
+            n_clusters=k,
+            batch_size=min(4096, len(Xs)),
+            n_init=5,
+            max_iter=100,
+            random_state=random_state,
+        )
+    else:
         km = KMeans(n_clusters=k, init="k-means++", n_init=20, random_state=random_state)
+
+    # 1 thread de BLAS/OpenMP por worker: o paralelismo já vem do joblib
+    with threadpool_limits(limits=1):
         km.fit(Xs)
-        wcss.append(float(km.inertia_))
-    return wcss
+    return float(km.inertia_)
+
+
+def calcular_wcss(
+    Xs: np.ndarray,
+    k_min: int = 2,
+    k_max: int = 10,
+    random_state: int = 42,
+    n_jobs: int = -1,
+    use_minibatch: bool = False,
+) -> list[float]:
+    """
+    WCSS para k_min..k_max. Os ajustes são independentes entre si,
+    então rodam em paralelo (um processo por k).
+    use_minibatch=True usa MiniBatchKMeans: bem mais rápido, mas o k do joelho passa
+    a variar com random_state (recomendado só a partir de MINIBATCH_MIN_CLIENTES).
+    """
+    return Parallel(n_jobs=n_jobs, prefer="processes")(
+        delayed(_fit_inertia)(Xs, k, random_state, use_minibatch)
+        for k in range(k_min, k_max + 1)
+    )
 
 
 def get_numero_otimo_clusters(wcss: list[float], k_min: int = 2, k_max: int = 10) -> int:
@@ -77,38 +249,55 @@ def get_numero_otimo_clusters(wcss: list[float], k_min: int = 2, k_max: int = 10
     Knee detection por distância à reta.
     wcss deve corresponder a k_min..k_max.
     """
-    x1, y1 = k_min, wcss[0]
-    x2, y2 = k_max, wcss[-1]
+    w = np.asarray(wcss, dtype=np.float64)
+    xs = np.arange(k_min, k_max + 1, dtype=np.float64)
+    x1, y1 = k_min, w[0]
+    x2, y2 = k_max, w[-1]
 
-    distancias = []
-    for i, y0 in enumerate(wcss):
-        x0 = k_min + i
-        numerador = abs((y2 - y1) * x0 - (x2 - x1) * y0 + x2 * y1 - y2 * x1)
-        denominador = math.sqrt((y2 - y1) ** 2 + (x2 - x1) ** 2)
-        distancias.append(numerador / denominador)
+    # O denominador (norma da reta) é constante: não altera o argmax
+    distancias = np.abs((y2 - y1) * xs - (x2 - x1) * w + x2 * y1 - y2 * x1)
 
-    return (k_min + int(np.argmax(distancias)))
+    return k_min + int(np.argmax(distancias))
 
 
 def cluster_rfm_joint(
     rfm: pd.DataFrame,
     n_clusters: int,
     random_state: int,
+    precomputed: tuple[np.ndarray, pd.DataFrame] | None = None,
+    copy_x: bool = True,
 ) -> tuple[pd.DataFrame, pd.DataFrame]:
     """
     KMeans conjunto no espaço padronizado (R_inv, F_log, M_log).
+    precomputed: saída de build_rfm_features(rfm), se já calculada (evita refazer o scaler).
+    copy_x=False deixa o KMeans centralizar o Xs de precomputed in place (e restaurar
+    depois), sem cópia; use só se quem chama é dono do array.
     Retorna:
     - rfm_clustered: tabela por cliente com ClusterId e ScoreComposto
     - cluster_profile: perfil agregado por cluster (insumo p/ LLM)
     """
-    Xs, enriched = build_rfm_features(rfm)
+    if precomputed is None:
+        Xs, enriched = build_rfm_features(rfm)
+    else:
+        Xs, enriched = precomputed
+        enriched = enriched.copy(deep=False)  # não altera o DataFrame de quem chamou
 
-    km = KMeans(n_clusters=n_clusters, random_state=random_state, n_init="auto")
+    # Mantém Lloyd (padrão): medido mais rápido que Elkan aqui (d=3, float32).
+    # Xs criado nesta função é nosso: nunca precisa de cópia
+    km = KMeans(
+        n_clusters=n_clusters,
+        random_state=random_state,
+        n_init="auto",
+        copy_x=copy_x and precomputed is not None,
+    )
     cluster_id = km.fit_predict(Xs)
     enriched["ClusterId"] = cluster_id
 
-    # Score composto (maior = melhor) no espaço padronizado
-    enriched["ScoreComposto"] = Xs.sum(axis=1)
+    # Score composto (maior = melhor) no espaço padronizado; média por cluster via bincount
+    scores = np.add.reduce(Xs, axis=1)
+    enriched["ScoreComposto"] = scores
+    counts = np.bincount(cluster_id, minlength=n_clusters)
+    score_mean = np.bincount(cluster_id, weights=scores, minlength=n_clusters) / counts
 
     # Perfil por cluster
     prof = (
@@ -121,10 +310,10 @@ def cluster_rfm_joint(
             Frequencia_mediana=("Frequencia", "median"),
             Receita_media=("Receita", "mean"),
             Receita_mediana=("Receita", "median"),
-            ScoreComposto_medio=("ScoreComposto", "mean"),
         )
         .reset_index()
     )
+    prof["ScoreComposto_medio"] = score_mean[prof["ClusterId"].to_numpy()]
 
     # Ordena clusters por ScoreComposto_medio (pior -> melhor)
     prof = prof.sort_values("ScoreComposto_medio", ascending=True).reset_index(drop=True)
@@ -133,19 +322,21 @@ def cluster_rfm_joint(
     prof["PctBase"] = (prof["Clientes"] / total).round(4)
 
     # junta o rank para cada cliente
-    enriched = enriched.merge(prof[["ClusterId", "RankQualidade"]], on="ClusterId", how="left")
+    rank_map = prof.set_index("ClusterId")["RankQualidade"].to_dict()
+    enriched["RankQualidade"] = enriched["ClusterId"].map(rank_map)
 
     # Limpa colunas auxiliares internas de features (mantém se quiser debug)
-    enriched = enriched.drop(columns=["R_inv", "F_log", "M_log"], errors="ignore")
+    enriched = enriched.drop(columns=["R_inv", "F_log", "M_log"])
 
     # Reordena colunas principais
     cols = ["Cliente", "Recencia", "Frequencia", "Receita", "ClusterId", "RankQualidade", "ScoreComposto"]
     enriched = enriched[cols]
 
     # Arredonda perfil para display
-    prof_display = prof.copy()
-    for c in prof_display.columns:
-        if c.endswith("_media") or c.endswith("_mediana") or "ScoreComposto" in c:
-            prof_display[c] = prof_display[c].astype(float).round(2)
+    num_cols = [
+        c for c in prof.columns
+        if c.endswith("_media") or c.endswith("_mediana") or "ScoreComposto" in c
+    ]
+    prof_display = prof.round({c: 2 for c in num_cols})
 
     return enriched, prof_display
\ No newline at end of file